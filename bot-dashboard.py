@@ -4,46 +4,76 @@
 # Distributed under the terms of the MIT-0 license, see LICENSE for details.
 # SPDX-License-Identifier: MIT-0
 
+import functools
 import json
 import requests
+import sys
 import time
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
+from pathlib import Path
 from typing import Literal
 from typing import Any, Callable, List, Tuple, TypeVar
+from requests.adapters import HTTPAdapter
 
-@dataclass
+# orjson is considerably faster at decoding the API responses, but isn't
+# required.
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Shared session so connections to lab.llvm.org are kept alive and reused
+# across bots, rather than doing a fresh TCP+TLS handshake for each request.
+# The pool is sized to allow all bots to be fetched concurrently.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# The only fields of a build used by build_data_to_build_info.
+BUILD_FIELDS = ("number", "started_at", "results", "complete_at")
+
+BASE_URLS = {
+    "staging": "https://lab.llvm.org/staging",
+    "production": "https://lab.llvm.org/buildbot",
+}
+
+# URLs only depend on immutable fields, so are computed once on construction
+# rather than each time the template refers to them.
+@dataclass(slots=True, frozen=True)
 class BotInfo:
     id: int
     name: str
     environment: Literal["staging", "production"]
     description: str
+    url: str = field(init=False, repr=False, compare=False)
+    api_url: str = field(init=False, repr=False, compare=False)
 
-    def get_url(self) -> str:
-        if self.environment == "staging":
-            base_url = "https://lab.llvm.org/staging"
-        elif self.environment == "production":
-            base_url = "https://lab.llvm.org/buildbot"
-        else:
+    def __post_init__(self):
+        if self.environment not in BASE_URLS:
             raise ValueError("Unknown environment")
-        return f"{base_url}/#/builders/{self.id}"
+        base_url = BASE_URLS[self.environment]
+        object.__setattr__(self, "url", f"{base_url}/#/builders/{self.id}")
+        field_params = "".join(f"&field={name}" for name in BUILD_FIELDS)
+        object.__setattr__(self, "api_url", f"{base_url}/api/v2/builders/{self.name}/builds?limit=2&order=-number{field_params}")
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class BuildInfo:
     id: int
     bot: BotInfo
     started_at: int
     result: Literal["pass", "fail", "in_progress", "other"]
     finished_at: int | None
+    url: str = field(init=False, repr=False, compare=False)
 
-    def get_url(self) -> str:
-        return f"{self.bot.get_url()}/builds/{self.id}"
+    def __post_init__(self):
+        object.__setattr__(self, "url", f"{self.bot.url}/builds/{self.id}")
 
     def get_seconds_since_started(self):
         return int(time.time()) - self.started_at
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class BotStatus:
     bot: BotInfo
     in_progress_build: BuildInfo | None
@@ -54,16 +84,30 @@ def compile_template(template_str: str) -> Callable[..., str]:
     out = []
     indent = 0
     stack = []
+    indents = [""]
 
     def emit_line(line: str) -> None:
-        out.append(f"{'    ' * indent}{line}")
+        while len(indents) <= indent:
+            indents.append(indents[-1] + "    ")
+        out.append(indents[indent] + line)
+
+    # Adjacent literal text is accumulated here and emitted as a single
+    # append() call once a directive or expression is reached.
+    pending_text = []
+
+    def flush_text() -> None:
+        if pending_text:
+            emit_line(f"append({repr(''.join(pending_text))})")
+            pending_text.clear()
 
     emit_line("def _render():")
     indent += 1
-    emit_line("out = []")
+    emit_line("buf = []")
+    emit_line("append = buf.append")
 
     for line_no, line in enumerate(template_str.splitlines(), start=1):
         if line.startswith("$"):
+            flush_text()
             pycmd = line[1:].strip()
             keyword = pycmd.partition(" ")[0]
             if keyword == "if":
@@ -97,18 +141,20 @@ def compile_template(template_str: str) -> Callable[..., str]:
         while pos <= len(line):
             expr_start = line.find("{{", pos)
             if expr_start == -1:
-                emit_line(f"out.append({repr(line[pos:])} '\\n')")
+                pending_text.append(line[pos:] + "\n")
                 break
             if expr_start != pos:
-                emit_line(f"out.append({repr(line[pos:expr_start])})")
+                pending_text.append(line[pos:expr_start])
             expr_end = line.find("}}", expr_start)
             if expr_end == -1:
                 raise ValueError(f"Line {line_no}: Couldn't find matching }}")
-            emit_line(f"out.append(str({line[expr_start + 2 : expr_end]}))")
+            flush_text()
+            emit_line(f"append(str({line[expr_start + 2 : expr_end]}))")
             pos = expr_end + 2
     if len(stack) != 0:
         raise ValueError(f"Unclosed '{stack[-1]}'")
-    emit_line('return "".join(out)')
+    flush_text()
+    emit_line('return "".join(buf)')
     py_code = "\n".join(out)
     compiled_code = compile(py_code, "<string>", "exec")
 
@@ -118,16 +164,18 @@ def compile_template(template_str: str) -> Callable[..., str]:
 
     return wrapper
 
+@functools.lru_cache(maxsize=1024)
 def seconds_to_readable(seconds):
+    seconds = int(seconds)
     if seconds < 60:
         return f"{seconds}s"
     minutes = seconds // 60
     if minutes < 60:
         return f"{minutes}m"
-    hours = minutes // 60
-    remaining_minutes = minutes % 60
+    hours, remaining_minutes = divmod(minutes, 60)
     return f"{hours}h{remaining_minutes}m"
 
+@functools.lru_cache(maxsize=1024)
 def timestamp_to_readable(timestamp):
     return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime('%Y-%m-%d %H:%M')
 
@@ -296,7 +344,7 @@ template_str=\
 </head>
 <body>
     <h1>RISC-V LLVM CI status</h1>
-    <p class="text-secondary">Generated at <span class="utc-time">{{timestamp_to_readable(time.time())}}</span>. <span id="timezone-notice">All times are given in UTC.</span> Regenerated approximately every 20 minutes.</p>
+    <p class="text-secondary">Generated at <span class="utc-time">{{timestamp_to_readable(int(time.time()))}}</span>. <span id="timezone-notice">All times are given in UTC.</span> Regenerated approximately every 20 minutes.</p>
 
     <div class="dashboard">
         <table>
@@ -311,7 +359,7 @@ template_str=\
 $ for bot_status in bot_statuses
                 <tr>
                     <td>
-                      <a href="{{bot_status.bot.get_url()}}">{{bot_status.bot.name}}</a>
+                      <a href="{{bot_status.bot.url}}">{{bot_status.bot.name}}</a>
                       <details class="text-secondary">
                         <summary>Info</summary>
                         {{bot_status.bot.description}}. Results reported to the {{bot_status.bot.environment}} buildbot coordinator.
@@ -319,7 +367,7 @@ $ for bot_status in bot_statuses
                      </td>
 $ if bot_status.in_progress_build
                     <td>
-                        <span class="status-in_progress build-number"><a href="{{bot_status.in_progress_build.get_url()}}">#{{bot_status.in_progress_build.id}}</a></span>
+                        <span class="status-in_progress build-number"><a href="{{bot_status.in_progress_build.url}}">#{{bot_status.in_progress_build.id}}</a></span>
                     <div class="text-secondary">{{seconds_to_readable(bot_status.in_progress_build.get_seconds_since_started())}} ago</div>
                     </td>
 $ else
@@ -327,7 +375,7 @@ $ else
 $ endif
                     <td>
 $ if bot_status.last_completed_build
-                        <div class="status-{{bot_status.last_completed_build.result}} build-number"><a href="{{bot_status.last_completed_build.get_url()}}">#{{bot_status.last_completed_build.id}}</a></div>
+                        <div class="status-{{bot_status.last_completed_build.result}} build-number"><a href="{{bot_status.last_completed_build.url}}">#{{bot_status.last_completed_build.id}}</a></div>
                         <div class="text-secondary">{{seconds_to_readable(bot_status.last_completed_build.finished_at - bot_status.last_completed_build.started_at)}} · <span class="utc-time">{{timestamp_to_readable(bot_status.last_completed_build.finished_at)}}</span></div>
 $ endif
                     </td>
@@ -355,34 +403,67 @@ BotInfo(188, "libc-riscv64-debian-dbg", "production", "LLVM libc RV64 build and
 BotInfo(196, "libc-riscv32-qemu-yocto-fullbuild-dbg", "production", "LLVM libc RV32 build and tests running by transferring each test to a Yocto build on qemu-system emulating RV32")
 ]
 
+# Responses are cached by URL along with their ETag/Last-Modified headers, so
+# that unchanged builders can be revalidated with a conditional GET and
+# answered with an empty 304 response. The publish workflow persists this
+# directory between runs with actions/cache.
+ETAG_CACHE_PATH = Path("~/.cache/riscv-dashboard/etags.json").expanduser()
+
+def load_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(path, cache):
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print(f"Error saving cache: {e}", file=sys.stderr)
+
+etag_cache = load_cache(ETAG_CACHE_PATH)
+
 def get_bot_builds(bot):
-    if bot.environment == "staging":
-        buildbot_url = "https://lab.llvm.org/staging"
-    elif bot.environment == "production":
-        buildbot_url = "https://lab.llvm.org/buildbot"
-    url = f"{buildbot_url}/api/v2/builders/{bot.name}/builds?limit=2&order=-number"
+    cached = etag_cache.get(bot.api_url)
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
     try:
-        response = requests.get(url)
+        response = SESSION.get(bot.api_url, headers=headers, timeout=10)
         response.raise_for_status()  # Raise an exception for 4XX/5XX responses
-        return response.json()
-    except requests.exceptions.RequestException as e:
+        if response.status_code == 304 and cached:
+            return cached["body"]
+        # Keep only the builds and fields that are used, so that what is held
+        # in memory and in the ETag cache is small even if the server
+        # ignores the field filter.
+        builds = json_loads(response.content)["builds"][:2]
+        body = {"builds": [{name: build.get(name) for name in BUILD_FIELDS} for build in builds]}
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag or last_modified:
+            etag_cache[bot.api_url] = {"etag": etag, "last_modified": last_modified, "body": body}
+        else:
+            etag_cache.pop(bot.api_url, None)
+        return body
+    # ValueError covers JSON decode errors from both orjson and json, and
+    # KeyError a response without the expected "builds" list.
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
         print(f"Error fetching data: {e}")
         return None
 
+# See <https://buildbot.readthedocs.io/en/latest/developer/results.html>
+RESULT_MAP = {None: "in_progress", 0: "pass", 1: "pass", 2: "fail"}
+
 def build_data_to_build_info(bot, build_data):
-    build_id = build_data.get('number')
-    started_at = int(build_data.get('started_at'))
-
-    # See <https://buildbot.readthedocs.io/en/latest/developer/results.html>
-    results = build_data.get('results')
-    if results is None:
-        result = "in_progress"
-    elif results == 0 or results == 1:
-        result = "pass"
-    elif results == 2:
-        result = "fail"
-    else:
-        result = "other"
+    build_id = build_data['number']
+    started_at = int(build_data['started_at'])
+    result = RESULT_MAP.get(build_data.get('results'), "other")
 
     # Check if the build has finished
     finished_at = build_data.get('complete_at')
@@ -408,5 +489,10 @@ def get_bot_status(bot, builds_data):
     else:
         return BotStatus(bot, None, build_info_0)
 
-bot_statuses = [get_bot_status(bot, get_bot_builds(bot)['builds']) for bot in riscv_bots]
+# Fetch builds for all bots concurrently, as the time spent is dominated by
+# waiting on the network.
+with ThreadPoolExecutor(max_workers=len(riscv_bots)) as executor:
+    all_bot_builds = list(executor.map(get_bot_builds, riscv_bots))
+save_cache(ETAG_CACHE_PATH, etag_cache)
+bot_statuses = [get_bot_status(bot, bot_builds['builds']) for bot, bot_builds in zip(riscv_bots, all_bot_builds)]
 print(compile_template(template_str)(bot_statuses=bot_statuses, seconds_to_readable=seconds_to_readable, timestamp_to_readable=timestamp_to_readable, time=time))